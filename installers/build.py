@@ -1,20 +1,109 @@
 #!/usr/bin/env python3
+import argparse
+import concurrent.futures
+import gzip
+import hashlib
+import io
+import json
 import os.path
 import re
+import select
+import shutil
+import struct
+import subprocess
+import sys
+import threading
+import time
+from typing import Callable
+from typing import Dict
 from typing import List
+from typing import NamedTuple
 from typing import Optional
 from typing import Set
+from typing import Tuple
+from typing import Union
+
+TARGETS = ["install.sh", "update.sh"]
 
 
 def main():
     """
     Build install.sh
     """
+    parser = argparse.ArgumentParser(description="Compile the installer scripts.")
+    parser.add_argument(
+        "-t",
+        "--target",
+        dest="targets",
+        action="append",
+        choices=TARGETS,
+        help="Script to build (repeatable, default: all)",
+    )
+    # pre-commit passes the changed files, but the include graph already
+    # knows which targets they affect.
+    parser.add_argument("files", nargs="*", help=argparse.SUPPRESS)
+    parser.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        help="Rebuild targets even if none of their inputs changed",
+    )
+    parser.add_argument(
+        "-O",
+        "--optimize",
+        action="store_true",
+        help="Strip comments and unused functions from the compiled scripts",
+    )
+    parser.add_argument(
+        "--artifacts",
+        metavar="DIR",
+        help="Also write gzip and zstd compressed scripts, and SHA256SUMS, to DIR",
+    )
+    parser.add_argument(
+        "-w",
+        "--watch",
+        action="store_true",
+        help="Keep running, rebuilding targets whenever one of their inputs changes",
+    )
+    args = parser.parse_args()
+
+    dotfiles = Dotfiles(optimize=args.optimize)
+    targets = args.targets or TARGETS
+    build(dotfiles, targets, args.force, args.artifacts, quiet=False)
+    if args.watch:
+        try:
+            dotfiles.watch(
+                targets,
+                lambda affected: build(dotfiles, affected, False, args.artifacts),
+            )
+        except KeyboardInterrupt:
+            pass
+
 
-    dotfiles = Dotfiles()
+def build(
+    dotfiles: "Dotfiles",
+    targets: List[str],
+    force: bool,
+    artifacts: Optional[str],
+    quiet: bool = True,
+) -> None:
+    """Compile targets and report on them, writing artifacts if any were rebuilt"""
+    rebuilt = False
+    for target, reason in dotfiles.compile_all(targets, force):
+        if reason is None:
+            if not quiet:
+                print(f"{target}: up to date")
+            continue
+        rebuilt = True
+        print(f"{target}: rebuilt ({reason})")
+        report = dotfiles.reports.get(target)
+        if report is not None:
+            print(f"  {report}")
+    dotfiles.state.save()
 
-    dotfiles.compile("install.sh")
-    dotfiles.compile("update.sh")
+    if artifacts and (rebuilt or not quiet):
+        for name in write_artifacts(dotfiles.dotfiles, TARGETS, artifacts):
+            print(f"{os.path.join(artifacts, name)}: written")
 
 
 SOURCE = re.compile(r"^(\s*)#.*?source=(\w\S+)(\s+.*$)")
@@ -30,34 +119,577 @@ BUILD_WARNING = """
 """
 
 
-class Dotfiles:
+class Directive(NamedTuple):
+    """A line of a shell file, classified for the compiler"""
+
+    # One of "line", "blank", "include" or "no-include"
+    kind: str
+    line: str
+    indent: str = ""
+    include: str = ""
+
+
+class ParsedFile(NamedTuple):
+    prelude: List[str]
+    body: List[Directive]
+
+
+def parse(filename: str) -> ParsedFile:
+    """
+    Split a shell file into its prelude and a list of directives.
+
+    The prelude runs up to and including `set -eu`. The line after each
+    include comment (which sources the file at runtime) is dropped, as the
+    included file replaces it.
+    """
+    with open(filename, "r") as source:
+        prelude = []
+        for line in source:
+            prelude.append(line)
+            if re.match(PRELUDE_END, line):
+                break
+        else:
+            raise ValueError(f"{filename} contained no content after prelude")
+
+        body = []
+        for line in source:
+            match = re.match(SOURCE, line)
+            if line.strip() == "":
+                body.append(Directive("blank", line))
+            elif match is None:
+                body.append(Directive("line", line))
+            elif "no-include" in match.group(3):
+                body.append(Directive("no-include", line))
+            else:
+                next(source, None)
+                body.append(Directive("include", line, match.group(1), match.group(2)))
+    return ParsedFile(prelude, body)
+
+
+class IncludeCache:
+    """Parsed shell files, shared by every target in a build"""
+
     def __init__(self) -> None:
-        self.installers = os.path.dirname(__file__)
+        self.files: Dict[str, ParsedFile] = {}
+        self.lock = threading.Lock()
+
+    def parse(self, filename: str) -> ParsedFile:
+        with self.lock:
+            parsed = self.files.get(filename)
+        if parsed is None:
+            parsed = parse(filename)
+            with self.lock:
+                parsed = self.files.setdefault(filename, parsed)
+        return parsed
+
+
+FUNCTION = re.compile(r"^(\s*)([A-Za-z_][A-Za-z0-9_]*)\s*\(\)\s*\{(.*)$")
+HEREDOC = re.compile(r"<<-?\s*(['\"]?)([A-Za-z_][A-Za-z0-9_]*)\1")
+WORD = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+
+
+class SizeReport(NamedTuple):
+    before: int
+    after: int
+    comments: int
+    functions: List[str]
+
+    def __str__(self) -> str:
+        saved = 1 - self.after / self.before if self.before else 0
+        removed = ", ".join(self.functions) if self.functions else "none"
+        return (
+            f"{self.before} -> {self.after} bytes ({saved:.0%} smaller), "
+            f"{self.comments} comment lines stripped, "
+            f"{len(self.functions)} unused functions removed ({removed})"
+        )
+
+
+def find_functions(lines: List[str]) -> List[Tuple[str, int, int]]:
+    """
+    Find function definitions, as (name, first line, last line) ranges.
+
+    A function ends at the first closing brace with the same indentation as
+    its definition, or on the same line for one-line functions. Definitions
+    without a matching end are ignored, so they are never removed.
+    """
+    functions = []
+    for start, line in enumerate(lines):
+        match = re.match(FUNCTION, line)
+        if match is None:
+            continue
+        if match.group(3).rstrip().endswith("}"):
+            functions.append((match.group(2), start, start))
+            continue
+        end_of_function = re.compile(re.escape(match.group(1)) + r"\}\s*$")
+        for end in range(start + 1, len(lines)):
+            if re.match(end_of_function, lines[end]):
+                functions.append((match.group(2), start, end))
+                break
+    return functions
+
+
+def unused_functions(lines: List[str]) -> Set[int]:
+    """
+    Line numbers of functions which can never be called from the script.
+
+    Functions are reachable when their name appears in top-level code, or in
+    the body of another reachable function. Names are matched as words, so
+    functions referenced in strings (e.g. by `trap`) are kept too.
+    """
+    functions = find_functions(lines)
+    owner: List[Optional[int]] = [None] * len(lines)
+    for index, (_, start, end) in enumerate(functions):
+        for number in range(start, end + 1):
+            # Later (nested) definitions take over the lines they contain.
+            owner[number] = index
+
+    words: List[Set[str]] = [set() for _ in functions]
+    top_level: Set[str] = set()
+    for number, line in enumerate(lines):
+        if number in (start for _, start, _ in functions):
+            # Don't count a definition as a reference to itself.
+            line = re.sub(FUNCTION, r"\3", line)
+        found = set(re.findall(WORD, line))
+        function = owner[number]
+        if function is None:
+            top_level |= found
+        else:
+            words[function] |= found
+
+    names: Dict[str, List[int]] = {}
+    for index, (name, _, _) in enumerate(functions):
+        names.setdefault(name, []).append(index)
+
+    reachable: Set[int] = set()
+    pending = [index for name in top_level for index in names.get(name, [])]
+    while pending:
+        index = pending.pop()
+        if index in reachable:
+            continue
+        reachable.add(index)
+        pending.extend(i for name in words[index] for i in names.get(name, []))
+
+    unused: Set[int] = set()
+    for index, (_, start, end) in enumerate(functions):
+        if index not in reachable:
+            unused.update(range(start, end + 1))
+    return unused
+
+
+def optimize(header: str, body: str) -> Tuple[str, SizeReport]:
+    """
+    Shrink a compiled script, leaving the header (shebang, prelude and warning) alone.
+
+    Comment lines are stripped, except for shellcheck directives, along with
+    blank lines and functions which are never called. Heredocs are copied
+    verbatim.
+    """
+    lines = body.splitlines(keepends=True)
+    unused = unused_functions(lines)
+    removed = sorted(
+        {name for name, start, _ in find_functions(lines) if start in unused}
+    )
+
+    kept = []
+    comments = 0
+    terminator = None
+    for number, line in enumerate(lines):
+        if terminator is not None:
+            kept.append(line)
+            if line.strip() == terminator:
+                terminator = None
+            continue
+        if number in unused:
+            continue
+        stripped = line.strip()
+        if stripped.startswith("#") and not stripped[1:].lstrip().startswith(
+            "shellcheck "
+        ):
+            comments += 1
+            continue
+        if stripped == "":
+            continue
+        match = re.search(HEREDOC, line)
+        if match is not None:
+            terminator = match.group(2)
+        kept.append(line)
+
+    text = header + "".join(kept)
+    report = SizeReport(
+        before=len((header + body).encode()),
+        after=len(text.encode()),
+        comments=comments,
+        functions=removed,
+    )
+    return text, report
+
+
+def source_date_epoch() -> int:
+    """The timestamp for reproducible artifacts, from SOURCE_DATE_EPOCH (default 0)"""
+    return int(os.environ.get("SOURCE_DATE_EPOCH", "0"))
+
+
+def gzip_compress(data: bytes) -> bytes:
+    """Compress data with gzip, with no file name and a fixed timestamp in the header"""
+    buffer = io.BytesIO()
+    with gzip.GzipFile(
+        filename="",
+        mode="wb",
+        compresslevel=9,
+        fileobj=buffer,
+        mtime=source_date_epoch(),
+    ) as stream:
+        stream.write(data)
+    return buffer.getvalue()
+
+
+def zstd_compress(data: bytes) -> Optional[bytes]:
+    """
+    Compress data with the zstd command, or return None if it isn't installed.
+
+    Only the command is used (not compression.zstd from Python 3.14+), as the
+    two produce different bytes, and the artifacts shouldn't depend on the
+    Python version. Settings which the environment could change are pinned.
+    """
+    if shutil.which("zstd") is None:
+        return None
+    env = {
+        name: value
+        for name, value in os.environ.items()
+        if name not in ("ZSTD_CLEVEL", "ZSTD_NBTHREADS")
+    }
+    return subprocess.run(
+        ["zstd", "-19", "--single-thread", "-q", "-c"],
+        input=data,
+        env=env,
+        capture_output=True,
+        check=True,
+    ).stdout
+
+
+def write_artifacts(dotfiles: str, targets: List[str], directory: str) -> List[str]:
+    """
+    Write each target with its compressed variants, and a SHA256SUMS manifest.
+
+    Artifacts are reproducible: compressed files carry no names or timestamps,
+    the manifest is sorted, and file modification times are set from
+    SOURCE_DATE_EPOCH. Returns the names of the files written.
+    """
+    os.makedirs(directory, exist_ok=True)
+    artifacts: Dict[str, bytes] = {}
+    for target in targets:
+        with open(os.path.join(dotfiles, target), "rb") as stream:
+            data = stream.read()
+        artifacts[target] = data
+        artifacts[f"{target}.gz"] = gzip_compress(data)
+        compressed = zstd_compress(data)
+        if compressed is None:
+            print(f"zstd is not available, skipping {target}.zst")
+        else:
+            artifacts[f"{target}.zst"] = compressed
+
+    manifest = "".join(
+        f"{hashlib.sha256(data).hexdigest()}  {name}\n"
+        for name, data in sorted(artifacts.items())
+    )
+    artifacts["SHA256SUMS"] = manifest.encode()
+
+    timestamp = source_date_epoch()
+    for name, data in sorted(artifacts.items()):
+        filename = os.path.join(directory, name)
+        with open(filename, "wb") as stream:
+            stream.write(data)
+        os.utime(filename, (timestamp, timestamp))
+    return sorted(artifacts)
+
+
+def digest(filename: str) -> Optional[str]:
+    """SHA-256 of a file's contents, or None if it doesn't exist"""
+    try:
+        with open(filename, "rb") as stream:
+            return hashlib.sha256(stream.read()).hexdigest()
+    except FileNotFoundError:
+        return None
+
+
+class BuildState:
+    """
+    The include graph and content hashes recorded by the last build of each target.
+
+    A target is up to date when every input it included last time still has
+    the same hash, and its output hasn't been changed since it was written.
+    New includes can only appear by editing a file which was already an input,
+    so the recorded graph is enough to tell when a rebuild is needed.
+    """
+
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+        self.targets: Dict[str, Dict] = {}
+        try:
+            with open(filename, "r") as stream:
+                self.targets = json.load(stream)
+        except (OSError, ValueError):
+            pass
+
+    def reason(self, target: str, dotfiles: str, options: Dict) -> Optional[str]:
+        """Why target needs to be rebuilt, or None if it is up to date"""
+        record = self.targets.get(target)
+        if record is None:
+            return "no previous build"
+        if record.get("options", {}) != options:
+            return "build options changed"
+        if digest(os.path.join(dotfiles, target)) != record["output"]:
+            return "output missing or modified"
+        changed = [
+            filename
+            for filename, expected in record["inputs"].items()
+            if digest(os.path.join(dotfiles, filename)) != expected
+        ]
+        if changed:
+            return "changed: " + ", ".join(changed)
+        return None
+
+    def record(
+        self, target: str, dotfiles: str, inputs: List[str], options: Dict
+    ) -> None:
+        self.targets[target] = {
+            "inputs": {
+                filename: digest(os.path.join(dotfiles, filename))
+                for filename in inputs
+            },
+            "output": digest(os.path.join(dotfiles, target)),
+            "options": options,
+        }
+
+    def dependents(self, targets: List[str], dotfiles: str) -> Dict[str, Set[str]]:
+        """Map the path of every recorded input to the targets which include it"""
+        graph: Dict[str, Set[str]] = {}
+        for target in targets:
+            for filename in self.targets.get(target, {}).get("inputs", {}):
+                graph.setdefault(os.path.join(dotfiles, filename), set()).add(target)
+        return graph
+
+    def save(self) -> None:
+        with open(self.filename, "w") as stream:
+            json.dump(self.targets, stream, indent=2, sort_keys=True)
+            stream.write("\n")
+
+
+class Dotfiles:
+    def __init__(self, optimize: bool = False) -> None:
+        self.installers = os.path.dirname(os.path.abspath(__file__))
         self.dotfiles = os.path.dirname(self.installers)
+        self.state = BuildState(os.path.join(self.installers, ".build-state.json"))
+        self.cache = IncludeCache()
+        self.options = {"optimize": True} if optimize else {}
+        self.reports: Dict[str, SizeReport] = {}
+
+    def compile_all(
+        self, filenames: List[str], force: bool = False
+    ) -> List[Tuple[str, Optional[str]]]:
+        """Compile targets concurrently, returning (target, reason) for each in order"""
+        with concurrent.futures.ThreadPoolExecutor() as pool:
+            reasons = pool.map(
+                lambda filename: self.compile(filename, force), filenames
+            )
+            return list(zip(filenames, reasons))
+
+    def watch(self, targets: List[str], rebuild: Callable[[List[str]], None]) -> None:
+        """
+        Call rebuild with the affected targets whenever an input changes.
+
+        The directories holding every input in the include graph are
+        watched, and the set is updated after each rebuild, so new includes
+        are picked up and removed ones are dropped.
+        """
+        watcher = file_watcher()
+        print(f"Watching for changes ({type(watcher).__name__}), ^C to stop")
+        while True:
+            graph = self.state.dependents(targets, self.dotfiles)
+            watcher.watch({os.path.dirname(filename) for filename in graph})
+            changed = watcher.read(None)
+            # Editors often write a file in several steps, so wait for the rest.
+            time.sleep(WATCH_DEBOUNCE)
+            changed |= watcher.read(0)
+
+            affected = sorted({t for f in changed for t in graph.get(f, set())})
+            if not affected:
+                continue
+            # Parsed files may be stale now, so start with a fresh cache.
+            self.cache = IncludeCache()
+            try:
+                rebuild(affected)
+            except (OSError, ValueError) as error:
+                print(f"Build failed: {error}", file=sys.stderr)
+
+    def compile(self, filename: str, force: bool = False) -> Optional[str]:
+        """Compile filename if needed, returning why it was rebuilt (or None)"""
+        reason = (
+            "forced"
+            if force
+            else self.state.reason(filename, self.dotfiles, self.options)
+        )
+        if reason is None:
+            return None
 
-    def compile(self, filename: str) -> None:
         source = os.path.join(self.installers, filename)
-        Script(
-            dotfiles=self.dotfiles, destination=os.path.join(self.dotfiles, filename)
-        ).process(source)
+        destination = os.path.join(self.dotfiles, filename)
+        script = Script(
+            dotfiles=self.dotfiles, destination=destination, cache=self.cache
+        )
+        script.process(source)
+        header, body = script.header(), script.body()
+        if self.options.get("optimize"):
+            text, self.reports[filename] = optimize(header, body)
+        else:
+            text = header + body
+        with open(destination, "w") as stream:
+            stream.write(text)
+
+        # The compiler itself is an input too, so changing it rebuilds everything.
+        inputs = [os.path.relpath(__file__, self.dotfiles), *script.inputs]
+        self.state.record(filename, self.dotfiles, inputs, self.options)
+        return reason
+
+
+WATCH_DEBOUNCE = 0.02
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+class Inotify:
+    """Watches directories for changed files with Linux inotify"""
+
+    mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def __init__(self) -> None:
+        import ctypes
+        import ctypes.util
+
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or None, use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm_watch = libc.inotify_rm_watch
+        self.fd = libc.inotify_init1(0)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.directories: Dict[int, str] = {}
+
+    def watch(self, directories: Set[str]) -> None:
+        """Watch exactly these directories"""
+        for wd, directory in list(self.directories.items()):
+            if directory not in directories:
+                self._rm_watch(self.fd, wd)
+                del self.directories[wd]
+        for directory in directories - set(self.directories.values()):
+            wd = self._add_watch(self.fd, os.fsencode(directory), self.mask)
+            if wd >= 0:
+                self.directories[wd] = directory
+
+    def read(self, timeout: Optional[float]) -> Set[str]:
+        """Wait up to timeout seconds for events, returning the changed paths"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        data = os.read(self.fd, 1 << 16)
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, _, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            end = offset + length
+            name = os.fsdecode(data[offset:end].rstrip(b"\0"))
+            offset = end
+            directory = self.directories.get(wd)
+            if directory is not None and name:
+                changed.add(os.path.join(directory, name))
+        return changed
+
+
+class Poller:
+    """Watches directories for changed files by polling modification times"""
+
+    def __init__(self, interval: float = 0.25) -> None:
+        self.interval = interval
+        self.mtimes: Dict[str, int] = {}
+        self.directories: Set[str] = set()
+
+    def scan(self) -> Dict[str, int]:
+        mtimes = {}
+        for directory in self.directories:
+            try:
+                entries = list(os.scandir(directory))
+            except OSError:
+                continue
+            for entry in entries:
+                if entry.is_file():
+                    mtimes[entry.path] = entry.stat().st_mtime_ns
+        return mtimes
+
+    def watch(self, directories: Set[str]) -> None:
+        if directories != self.directories:
+            self.directories = set(directories)
+            self.mtimes = self.scan()
+
+    def read(self, timeout: Optional[float]) -> Set[str]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            mtimes = self.scan()
+            changed = {
+                filename
+                for filename in mtimes.keys() | self.mtimes.keys()
+                if mtimes.get(filename) != self.mtimes.get(filename)
+            }
+            self.mtimes = mtimes
+            if changed or (deadline is not None and time.monotonic() >= deadline):
+                return changed
+            time.sleep(self.interval)
+
+
+def file_watcher() -> Union[Inotify, Poller]:
+    """Use inotify where available, otherwise poll"""
+    if sys.platform.startswith("linux"):
+        try:
+            return Inotify()
+        except (OSError, AttributeError):
+            pass
+    return Poller()
 
 
 class Script:
-    def __init__(self, dotfiles: str, destination: str):
+    def __init__(
+        self, dotfiles: str, destination: str, cache: Optional[IncludeCache] = None
+    ):
+        self.cache = cache if cache is not None else IncludeCache()
         self.include_prelude = True
         self.imports: Set[str] = set()
+        self.inputs: List[str] = []
         self.dotfiles = dotfiles
-        self.destination_file = open(destination, "w")
+        self.output: List[str] = []
+        self.header_size = 0
         self.destination = os.path.relpath(destination, self.dotfiles)
         self.indents: List[str] = []
 
     def write(self, line: str) -> None:
         if line.strip() == "":
             # Avoid writing blank lines with only whitespace from indents
-            self.destination_file.write("\n")
+            self.output.append("\n")
             return
         indent = "".join(self.indents)
-        self.destination_file.write(indent + line)
+        self.output.append(indent + line)
+
+    def header(self) -> str:
+        """The prelude and generated file warning"""
+        size = self.header_size
+        return "".join(self.output[:size])
+
+    def body(self) -> str:
+        size = self.header_size
+        return "".join(self.output[size:])
 
     def write_line(self, line: str) -> None:
         self.write(line + "\n")
@@ -78,62 +710,48 @@ class Script:
                 source=os.path.relpath(filename, self.dotfiles),
             )
         )
+        self.header_size = len(self.output)
 
     def process(self, filename: str) -> None:
-        line: Optional[str]
-        with open(filename, "r") as source:
-            for line in source:
-                if self.include_prelude:
+        parsed = self.cache.parse(filename)
+        self.inputs.append(os.path.relpath(filename, self.dotfiles))
+        if self.include_prelude:
+            for line in parsed.prelude:
+                self.write(line)
+            # Now we can include the warning
+            self.write_warning(filename)
+            # We have included the prelude once, don't do it again
+            self.include_prelude = False
+
+        previous_blank_line = False
+        for directive in parsed.body:
+            line = directive.line
+            if directive.kind == "blank":
+                previous_blank_line = True
+                # Skip blank lines
+                continue
+            if previous_blank_line:
+                self.write_line("")
+            if directive.kind == "no-include":
+                self.write(line)
+            elif directive.kind == "include":
+                self.indents.append(directive.indent)
+                include = os.path.join(self.dotfiles, directive.include)
+                include_relpath = os.path.relpath(include, self.dotfiles)
+                if include_relpath in self.imports:
+                    self.write_line(f"# Already included {include_relpath}")
                     self.write(line)
-                if re.match(PRELUDE_END, line):
-                    if self.include_prelude:
-                        # Now we can include the warning
-                        self.write_warning(filename)
-                    # We have included the prelude once, don't do it again
-                    self.include_prelude = False
-
-                    break
-            else:
-                raise ValueError(f"{filename} contained no content after prelude")
-
-            # Use while-true here becasue we might want to skip multiple lines.
-            previous_blank_line = False
-            while True:
-                line = next(source, None)
-                if line is None:
-                    # All done here
-                    break
-                if line.strip() == "":
-                    previous_blank_line = True
-                    # Skip blank lines
-                    continue
-                if previous_blank_line and line.strip() != "":
-                    self.write_line("")
-                match = re.match(SOURCE, line)
-                if match:
-                    tags = match.group(3)
-                    if "no-include" in tags:
-                        self.write(line)
-                    else:
-                        # Skip the next line too
-                        next(source, None)
-                        self.indents.append(match.group(1))
-                        include = os.path.join(self.dotfiles, match.group(2))
-                        include_relpath = os.path.relpath(include, self.dotfiles)
-                        if include_relpath in self.imports:
-                            self.write_line(f"# Already included {include_relpath}")
-                            self.write(line)
-                        else:
-                            self.imports.add(include_relpath)
-                            if not previous_blank_line:
-                                self.write_line("")
-                            self.write_line(f"# BEGIN included from {include_relpath}")
-                            self.process(include)
-                            self.write_line(f"# END included from {include_relpath}")
-                        self.indents.pop()
                 else:
-                    self.write(line)
-                    previous_blank_line = line.strip() == ""
+                    self.imports.add(include_relpath)
+                    if not previous_blank_line:
+                        self.write_line("")
+                    self.write_line(f"# BEGIN included from {include_relpath}")
+                    self.process(include)
+                    self.write_line(f"# END included from {include_relpath}")
+                self.indents.pop()
+            else:
+                self.write(line)
+                previous_blank_line = False
 
 
 if __name__ == "__main__":
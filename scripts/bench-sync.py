@@ -0,0 +1,422 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for bin/sync.py.
+
+The startup suite measures the cold start time of common sync.py
+invocations, and fails if they are slower than their targets (by default
+STARTUP_TARGETS, or --target-help and --target-up in seconds). Targets are
+for the time sync.py adds to starting python and importing click, and are
+checked against the fastest run, which is the least disturbed by whatever
+else the machine is doing:
+
+    scripts/bench-sync.py startup --repeat 20 --target-help 0.05 --target-up 0.2
+
+The transfer suite generates synthetic project trees (many small files,
+a few huge files, deep nesting and excluded directories) and reports wall
+time, bytes sent and received and files scanned for `up` and `down` (with
+rsync, and in bulk mode), `do` and `push` in each of them:
+
+    scripts/bench-sync.py transfer --json results.json
+    scripts/bench-sync.py transfer --compare results.json
+
+Both suites run against a local stand-in for the remote host (an ssh
+replacement which runs commands locally), or against a real sshd with
+`--ssh "ssh -p 22 localhost"`. Cases which need rsync are skipped when
+it is not installed.
+"""
+import argparse
+import json
+import os
+import re
+import shlex
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+SYNC = Path(__file__).resolve().parent.parent / "bin" / "sync.py"
+
+# Stands in for ssh: drops ssh options and the host, then runs the
+# remote command locally. Control (-O) requests always succeed.
+FAKE_SSH = """#!/bin/sh
+control=""
+while [ $# -gt 0 ]; do
+  case "$1" in
+    -[bcDeEFiIJlLmOpQRSwW]) [ "$1" = "-O" ] && control="$2"; shift 2 ;;
+    -o) shift 2 ;;
+    -*) shift ;;
+    *) break ;;
+  esac
+done
+[ -n "$control" ] && exit 0
+shift
+[ $# -eq 0 ] && exit 0
+exec sh -c "$*"
+"""
+
+EXCLUDES = ["results/*", "data/*"]
+
+# Default cold start targets for the startup suite: seconds on top of the
+# time to start python and import click.
+STARTUP_TARGETS = {"help": 0.05, "up": 0.2}
+
+# Scenario name -> (description, generator)
+SCENARIOS = {}
+
+# Patterns for the parts of rsync's --stats output we report.
+STATS = {
+    "files": re.compile(r"Number of files: ([\d,]+)"),
+    "sent": re.compile(r"Total bytes sent: ([\d,]+)"),
+    "received": re.compile(r"Total bytes received: ([\d,]+)"),
+}
+
+
+def scenario(description):
+    def register(f):
+        SCENARIOS[f.__name__.replace("_", "-")] = (description, f)
+        return f
+
+    return register
+
+
+def write_file(path, size):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open("wb") as stream:
+        remaining = size
+        while remaining > 0:
+            block = min(remaining, 1 << 20)
+            stream.write(os.urandom(block))
+            remaining -= block
+
+
+@scenario("many small files")
+def small_files(root, scale):
+    for index in range(int(2000 * scale)):
+        write_file(root / f"pkg{index % 20}" / f"module_{index}.py", 1024)
+
+
+@scenario("a few huge files")
+def huge_files(root, scale):
+    for index in range(2):
+        write_file(root / "models" / f"checkpoint_{index}.bin", int((16 << 20) * scale))
+
+
+@scenario("deeply nested directories")
+def deep_nesting(root, scale):
+    for branch in range(max(int(10 * scale), 1)):
+        path = root / f"branch{branch}"
+        for depth in range(16):
+            path = path / f"level{depth}"
+            write_file(path / "file.txt", 512)
+
+
+@scenario("large excluded directories")
+def excluded_dirs(root, scale):
+    write_file(root / "src" / "main.py", 1024)
+    for index in range(int(200 * scale)):
+        write_file(root / "data" / f"part_{index}.parquet", 64 << 10)
+        write_file(root / "results" / f"run_{index}.json", 4 << 10)
+
+
+def make_config(project, remote, ssh_args, host, repo=None):
+    config = {
+        "remote": {"path": str(remote), "ssh": {"args": ssh_args, "host": host}},
+        "rsync": {"excludes": EXCLUDES, "options": ["-a", "-z", "-u", "--stats"]},
+    }
+    if repo is not None:
+        config["repo"] = {"path": str(repo)}
+    # JSON is valid YAML, and keeps this script free of dependencies.
+    (project / ".sync.yml").write_text(json.dumps(config, indent=2))
+
+
+def stand_in(root, ssh):
+    """Return (ssh args, host) for the remote, writing the local stand-in if needed."""
+    if ssh:
+        *args, host = shlex.split(ssh)
+        return args, host
+    fake = Path(root) / "bin" / "ssh"
+    fake.parent.mkdir(parents=True, exist_ok=True)
+    fake.write_text(FAKE_SSH)
+    fake.chmod(0o755)
+    return [str(fake)], "localhost"
+
+
+def run_sync(project, *args, check=True):
+    """Run sync.py in project, returning (wall time, combined output)."""
+    env = dict(os.environ, SHELL="/bin/sh")
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, str(SYNC), *args],
+        cwd=project,
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        stdin=subprocess.DEVNULL,
+        text=True,
+    )
+    elapsed = time.perf_counter() - start
+    if check and result.returncode:
+        sys.stderr.write(result.stdout)
+        raise SystemExit(f"sync.py {' '.join(args)} failed with {result.returncode}")
+    return elapsed, result.stdout
+
+
+def parse_stats(output):
+    """Sum rsync --stats counters across all rsync runs in the output."""
+    stats = {}
+    for name, pattern in STATS.items():
+        matches = pattern.findall(output)
+        if matches:
+            stats[name] = sum(int(match.replace(",", "")) for match in matches)
+    return stats
+
+
+def git(*args, cwd):
+    subprocess.run(
+        ["git", "-c", "user.name=bench", "-c", "user.email=bench@localhost", *args],
+        cwd=cwd,
+        check=True,
+        capture_output=True,
+    )
+
+
+def make_repos(root, project):
+    """Turn project into a git repo with an origin, and a clone of it as the remote repo."""
+    origin = root / "origin.git"
+    repo = root / "remote-repo"
+    git("init", "-q", "-b", "main", cwd=project)
+    git("add", "-A", cwd=project)
+    git("commit", "-q", "-m", "bench", cwd=project)
+    git("init", "-q", "--bare", str(origin), cwd=root)
+    git("remote", "add", "origin", str(origin), cwd=project)
+    git("push", "-q", "origin", "main", cwd=project)
+    git("clone", "-q", "-b", "main", str(origin), str(repo), cwd=root)
+    (project / "CHANGES").write_text("bench\n")
+    git("add", "CHANGES", cwd=project)
+    git("commit", "-q", "-m", "change", cwd=project)
+    return repo
+
+
+def bench_scenario(name, generator, args, root):
+    """Run each transfer case in one scenario, returning a list of results."""
+    root = Path(root)
+    project = root / "project"
+    remote = root / "remote"
+    project.mkdir()
+    remote.mkdir()
+    generator(project, args.scale)
+
+    ssh_args, host = stand_in(root, args.ssh)
+    repo = make_repos(root, project) if shutil.which("git") else None
+    make_config(project, remote, ssh_args, host, repo)
+
+    # Transfers into an empty remote or local directory would switch to bulk
+    # mode on their own, so the rsync cases turn it off, and bulk mode gets
+    # cases of its own.
+    cases = []
+    if shutil.which("rsync"):
+        cases.append(("up", ["up", "--full", "--no-bulk"], None))
+        cases.append(("up (no-op)", ["up"], None))
+        cases.append(
+            (
+                f"up -j{args.jobs}",
+                ["up", "--full", "--no-bulk", "-j", str(args.jobs)],
+                "fresh",
+            )
+        )
+        cases.append(("down", ["down", "--no-bulk"], "empty-local"))
+    if shutil.which("tar"):
+        cases.append(("up --bulk", ["up", "--bulk"], "fresh"))
+        cases.append(("down --bulk", ["down", "--bulk"], "empty-local"))
+    cases.append(("do", ["do", "--", "true"], None))
+    if repo is not None:
+        cases.append(("push", ["push"], None))
+
+    results = []
+    for case, command, setup in cases:
+        workdir = project
+        if setup == "fresh":
+            shutil.rmtree(remote)
+            remote.mkdir()
+        elif setup == "empty-local":
+            workdir = root / f"download-{len(results)}"
+            workdir.mkdir()
+            shutil.copy(project / ".sync.yml", workdir / ".sync.yml")
+        elapsed, output = run_sync(workdir, *command)
+        results.append(
+            dict(scenario=name, case=case, wall=elapsed, **parse_stats(output))
+        )
+    return results
+
+
+def format_size(size):
+    if size is None:
+        return "-"
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            break
+        size /= 1024
+    return f"{size:.0f}{unit}" if unit == "B" else f"{size:.1f}{unit}"
+
+
+def print_results(results, baseline=None, threshold=0.2):
+    """Print a results table, flagging regressions against a baseline."""
+    previous = {(r["scenario"], r["case"]): r for r in baseline or []}
+    print(
+        f"{'scenario':<14} {'case':<12} {'wall':>8} {'sent':>9} "
+        f"{'received':>9} {'files':>7}  change"
+    )
+    regressions = 0
+    for result in results:
+        change = ""
+        before = previous.get((result["scenario"], result["case"]))
+        if before is not None and before["wall"]:
+            ratio = result["wall"] / before["wall"] - 1
+            change = f"{ratio:+.0%}"
+            if ratio > threshold:
+                change += " REGRESSION"
+                regressions += 1
+        print(
+            f"{result['scenario']:<14} {result['case']:<12} {result['wall']:>7.2f}s "
+            f"{format_size(result.get('sent')):>9} "
+            f"{format_size(result.get('received')):>9} "
+            f"{result.get('files', '-'):>7}  {change}"
+        )
+    return regressions
+
+
+def transfer(args):
+    names = args.scenario or list(SCENARIOS)
+    results = []
+    for name in names:
+        _, generator = SCENARIOS[name]
+        with tempfile.TemporaryDirectory(prefix=f"bench-sync-{name}-") as tmpdir:
+            results.extend(bench_scenario(name, generator, args, tmpdir))
+
+    baseline = None
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text())
+    regressions = print_results(results, baseline, args.threshold)
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2))
+    if not shutil.which("rsync"):
+        print("rsync not installed: up and down cases were skipped")
+    return 1 if regressions else 0
+
+
+def timed(command, cwd, repeat):
+    """Run command repeat times, returning the wall time of each run."""
+    # Measure with bytecode caching on, as sync.py is normally run.
+    env = {k: v for k, v in os.environ.items() if k != "PYTHONDONTWRITEBYTECODE"}
+    # Warm up once, which also populates any caches sync.py keeps.
+    subprocess.run(command, cwd=cwd, env=env, check=True, capture_output=True)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=cwd, env=env, check=True, capture_output=True)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def report(name, times, target=None, floor=None):
+    """Print timings; with a floor, check the time on top of it against target."""
+    median = statistics.median(times)
+    line = f"{name:<12} median {median:.3f}s  min {min(times):.3f}s"
+    if floor is None:
+        print(line)
+        return True
+    overhead = min(times) - floor
+    status = "ok" if target is None or overhead <= target else "SLOW"
+    target_text = "" if target is None else f" (target {target:.3f}s)"
+    print(f"{line}  overhead {overhead:.3f}s{target_text}  {status}")
+    return status == "ok"
+
+
+def startup(args):
+    ok = True
+    with tempfile.TemporaryDirectory(prefix="bench-sync-") as tmpdir:
+        root = Path(tmpdir)
+        project = root / "project"
+        remote = root / "remote"
+        remote.mkdir()
+        small_files(project, 0.05)
+        ssh_args, host = stand_in(root, args.ssh)
+        make_config(project, remote, ssh_args, host)
+
+        times = timed([sys.executable, "-c", "import click"], project, args.repeat)
+        floor = min(times)
+        report("python", times)
+
+        times = timed([sys.executable, str(SYNC), "--help"], project, args.repeat)
+        ok &= report("--help", times, args.target_help, floor)
+
+        if shutil.which("rsync"):
+            times = timed(
+                [sys.executable, str(SYNC), "-n", "up", "--full"], project, args.repeat
+            )
+            ok &= report("-n up", times, args.target_up, floor)
+        else:
+            print("-n up        skipped (rsync not installed)")
+
+    return 0 if ok else 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--ssh",
+        default=None,
+        help="Full ssh command for a real remote, instead of the local stand-in.",
+    )
+    suites = parser.add_subparsers(dest="suite", required=True)
+
+    parser_startup = suites.add_parser("startup", help="Cold start time.")
+    parser_startup.add_argument("--repeat", type=int, default=10, help="Runs per case.")
+    parser_startup.add_argument(
+        "--target-help",
+        type=float,
+        default=STARTUP_TARGETS["help"],
+        help="Target for --help (s).",
+    )
+    parser_startup.add_argument(
+        "--target-up",
+        type=float,
+        default=STARTUP_TARGETS["up"],
+        help="Target for -n up (s).",
+    )
+    parser_startup.set_defaults(run=startup)
+
+    parser_transfer = suites.add_parser("transfer", help="Transfer throughput.")
+    parser_transfer.add_argument(
+        "--scenario",
+        action="append",
+        choices=sorted(SCENARIOS),
+        help="Scenario to run (repeatable, default: all): "
+        + ", ".join(f"{name} ({info[0]})" for name, info in SCENARIOS.items()),
+    )
+    parser_transfer.add_argument(
+        "--scale", type=float, default=1.0, help="Scale file counts and sizes."
+    )
+    parser_transfer.add_argument(
+        "--jobs", type=int, default=4, help="Workers for the sharded up case."
+    )
+    parser_transfer.add_argument("--json", help="Write results to this file.")
+    parser_transfer.add_argument("--compare", help="Compare with a results file.")
+    parser_transfer.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="Slowdown (as a fraction) reported as a regression.",
+    )
+    parser_transfer.set_defaults(run=transfer)
+
+    args = parser.parse_args()
+    return args.run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
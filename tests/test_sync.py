@@ -0,0 +1,75 @@
+"""Tests for bin/lib/sync.py"""
+
+import importlib.util
+import json
+from pathlib import Path
+
+import pytest
+
+SYNC = Path(__file__).parent.parent / "bin" / "lib" / "sync.py"
+
+
+@pytest.fixture
+def sync(tmp_path, monkeypatch):
+    """The sync.py script as a module, caching into a temporary directory."""
+    spec = importlib.util.spec_from_file_location("sync", SYNC)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    monkeypatch.setattr(module, "__CACHE_DIR__", tmp_path / "cache")
+    monkeypatch.setattr(module, "LINK_CACHE", tmp_path / "cache" / "links.json")
+    return module
+
+
+def fake_ssh(path, rc):
+    """Write a fake ssh which answers `-V` and otherwise exits with rc."""
+    path.write_text(f'#!/bin/sh\n[ "$1" = "-V" ] && exit 0\nexit {rc}\n')
+    path.chmod(0o755)
+    return str(path)
+
+
+def test_link_profile_failed_probe(sync, tmp_path):
+    ssh = fake_ssh(tmp_path / "ssh", 255)
+    cfg = sync.Config(
+        {"remote": {"ssh": {"host": "box", "args": [ssh], "multiplex": False}}},
+        tmp_path / ".sync.yml",
+        environ={},
+    )
+    assert sync.measure_link(cfg, "box") is None
+    assert sync.link_profile(cfg) == "wan"
+    assert not sync.LINK_CACHE.exists()
+
+
+def test_link_profile_cached(sync, tmp_path):
+    ssh = fake_ssh(tmp_path / "ssh", 0)
+    cfg = sync.Config(
+        {"remote": {"ssh": {"host": "box", "args": [ssh], "multiplex": False}}},
+        tmp_path / ".sync.yml",
+        environ={},
+    )
+    profile = sync.link_profile(cfg)
+    assert json.loads(sync.LINK_CACHE.read_text())["box"]["profile"] == profile
+
+
+def test_no_probe_without_transfer(sync, tmp_path):
+    log = tmp_path / "calls"
+    ssh = tmp_path / "ssh"
+    ssh.write_text(f'#!/bin/sh\necho "$@" >> {log}\n')
+    ssh.chmod(0o755)
+    cfg = sync.Config(
+        {"remote": {"ssh": {"host": "box", "args": [str(ssh)], "multiplex": False}}},
+        tmp_path / ".sync.yml",
+        environ={},
+    )
+    assert sync.rsync_profile(cfg) == "unknown"
+    cfg.set_runtime("rsync.dry_run", True)
+    assert "--compress-level=1" in sync.rsync_command(cfg, "box:/remote", tmp_path)
+    assert not log.exists()
+
+
+def test_write_atomic_keeps_mode(sync, tmp_path):
+    path = tmp_path / ".sync.yml"
+    path.write_text("old")
+    path.chmod(0o644)
+    sync.write_atomic(path, "new")
+    assert path.read_text() == "new"
+    assert path.stat().st_mode & 0o777 == 0o644